@@ -7,7 +7,11 @@ import pyparsing as pp
 import unicodecsv as csv
 import pandas as pd
 import os
+import queue
+import tempfile
+import threading
 import tkinter as tk
+from tkinter import ttk
 from tkinter import simpledialog
 from tkinter import filedialog
 from tkinter import messagebox
@@ -19,6 +23,25 @@ node_count = 0
 line_count = 0
 
 
+# raised inside a worker task when the user pressed cancel
+class Cancelled(Exception):
+    pass
+
+# ProgressWriter: wraps a csv writer, calls progress(text) every `every` rows so a worker can report and cancel
+class ProgressWriter:
+    def __init__(self, writer, progress, every=100):
+        self.writer = writer
+        self.progress = progress
+        self.every = every
+        self.rows = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
+        if self.rows % self.every == 0:
+            self.progress("Wrote %d lines" % self.rows)
+
+
 # classes for all F1 lexical groups:
 # Node: base case for all tree nodes
 class Node:
@@ -184,13 +207,17 @@ class VP(Phrase):
                 self.write_line_node("R1", writer, using_text=False, v_name=v_name)
             elif vp_type == ["Vt", "N"]:
                 old = self.value_as_text
-                self.value_as_text = "{x: <x,%s> ∈ %s}" % (self.children[1].text, self.children[0].value_as_item)
-                self.value_as_text = self.value_as_text.replace("(", "<").replace(")", ">")
-                self.value_as_text = self.value_as_text.replace("[", "{").replace("]", "}")
-                Node.write_line_node(self, "L%d,L%d,L%d" %
-                                     (self.line_num - 1, self.children[0].line_num, self.children[1].line_num_v),
-                                     writer, v_name=v_name)
-                self.value_as_text = old
+                # restored in finally so a cancelled evaluation does not leave v values in the text
+                try:
+                    self.value_as_text = "{x: <x,%s> ∈ %s}" % (self.children[1].text,
+                                                               self.children[0].value_as_item)
+                    self.value_as_text = self.value_as_text.replace("(", "<").replace(")", ">")
+                    self.value_as_text = self.value_as_text.replace("[", "{").replace("]", "}")
+                    Node.write_line_node(self, "L%d,L%d,L%d" %
+                                         (self.line_num - 1, self.children[0].line_num, self.children[1].line_num_v),
+                                         writer, v_name=v_name)
+                finally:
+                    self.value_as_text = old
                 self.value_as_item = [x[0] for x in self.children[0].value_as_item if x[1] ==
                                       self.children[1].value_as_item]
                 self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
@@ -230,34 +257,38 @@ class S(Phrase):
         else:
             Phrase.evaluate_in_v(self, v_name, writer, v, verb_dict_v)
             old = self.value_as_text
-            if self.s_type == ["N", "VP"]:
-                self.value_as_text = self.value_as_text.replace(self.children[1].value_as_text,
-                                                                "%s" % self.children[1].value_as_item)
-                self.value_as_text = self.value_as_text.replace("(", "<").replace(")", ">")
-                self.value_as_text = self.value_as_text.replace("[", "{").replace("]", "}")
-                Node.write_line_node(self, "L%d,L%d" %
-                                     (self.line_num, self.children[1].line_num_v),
-                                     writer, v_name=v_name)
-                self.value_as_item = (self.children[0].value_as_item.lower() in self.children[1].value_as_item)
-                self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
-            elif self.s_type == ["Neg", "S"]:
-                self.value_as_text = "%s(%s)" % (self.children[0].value_as_text, self.children[1].value_as_item)
-                Node.write_line_node(self, "L%d,L%d" %
-                                     (self.line_num - 1, self.children[1].line_num_v),
-                                     writer, v_name=v_name)
-                self.value_as_item = self.children[0].value_as_item(self.children[1].value_as_item)
-                self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
-            elif self.s_type == ["S", "Conj", "S"]:
-                self.value_as_text = "%s(<%s,%s>)" % (self.children[1].value_as_text, self.children[0].value_as_item,
-                                                      self.children[2].value_as_item)
-                self.write_line_node("L%d,L%d,L%d" %
-                                     (self.line_num - 1, self.children[0].line_num_v, self.children[2].line_num_v),
-                                     writer, v_name=v_name)
-                self.value_as_item = self.children[1].value_as_item(self.children[0].value_as_item,
-                                                                    self.children[2].value_as_item)
-                self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
-            v[self.name] = self.value_as_item
-            self.value_as_text = old
+            # restored in finally so a cancelled evaluation does not leave v values in the text
+            try:
+                if self.s_type == ["N", "VP"]:
+                    self.value_as_text = self.value_as_text.replace(self.children[1].value_as_text,
+                                                                    "%s" % self.children[1].value_as_item)
+                    self.value_as_text = self.value_as_text.replace("(", "<").replace(")", ">")
+                    self.value_as_text = self.value_as_text.replace("[", "{").replace("]", "}")
+                    Node.write_line_node(self, "L%d,L%d" %
+                                         (self.line_num, self.children[1].line_num_v),
+                                         writer, v_name=v_name)
+                    self.value_as_item = (self.children[0].value_as_item.lower() in self.children[1].value_as_item)
+                    self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
+                elif self.s_type == ["Neg", "S"]:
+                    self.value_as_text = "%s(%s)" % (self.children[0].value_as_text, self.children[1].value_as_item)
+                    Node.write_line_node(self, "L%d,L%d" %
+                                         (self.line_num - 1, self.children[1].line_num_v),
+                                         writer, v_name=v_name)
+                    self.value_as_item = self.children[0].value_as_item(self.children[1].value_as_item)
+                    self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
+                elif self.s_type == ["S", "Conj", "S"]:
+                    self.value_as_text = "%s(<%s,%s>)" % (self.children[1].value_as_text,
+                                                          self.children[0].value_as_item,
+                                                          self.children[2].value_as_item)
+                    self.write_line_node("L%d,L%d,L%d" %
+                                         (self.line_num - 1, self.children[0].line_num_v, self.children[2].line_num_v),
+                                         writer, v_name=v_name)
+                    self.value_as_item = self.children[1].value_as_item(self.children[0].value_as_item,
+                                                                        self.children[2].value_as_item)
+                    self.write_line_node("C%d" % self.line_num_v, writer, using_text=False, v_name=v_name)
+                v[self.name] = self.value_as_item
+            finally:
+                self.value_as_text = old
         return self.value_as_item
 
 
@@ -335,28 +366,36 @@ def build_conj_tree(sentence, depth=0):
     return conj_str.replace("; 0 o.w", "")
 
 # create main csv and call write tree, return sentece object
-def make_main_csv(dir_path, sentence):
+# the sentence is parsed before the file is opened, on a later failure the new csv is removed
+# progress (optional) is called with status text while lines are written
+def make_main_csv(dir_path, sentence, progress=None):
     file = None
-    sen = None
     filepath = r"%s\F1_temp.csv" % dir_path
+    if progress:
+        progress("Parsing sentence")
+    parse_tree = s.parseString(sentence)
     try:
         # file setup
         file = open(filepath, "wb")
         writer = csv.writer(file, encoding='utf-8')
         writer.writerow(["line", "expression", "rule"])
+        if progress:
+            writer = ProgressWriter(writer, progress)
 
         # bulding tree and file
-        sen = make_tree(s.parseString(sentence), writer)
-    except IOError:
-        print("file cant be opend")
-    except pp.ParseException:
-        print("bad sentence")
+        # a new node cache for each sentence, so a cancelled run does not hide nodes from the next one
+        return make_tree(parse_tree, writer, {})
+    except Exception:
+        if file:
+            file.close()
+            os.remove(filepath)
+        raise
     finally:
         if file:
             file.close()
-        return sen
 
 # get path and sentence object, make tree hirarchy csv (calls get_tree_hirarchy_lines)
+# on failure the partial tree csv is removed
 def make_hirarchy_csv(dir_path, sentence):
     tree_file = None
     filename = dir_path + "\\%s (tree).csv" % sentence.text
@@ -365,30 +404,66 @@ def make_hirarchy_csv(dir_path, sentence):
         tree_writer = csv.writer(tree_file, encoding='utf-8')
         lines = get_tree_hirarchy_lines(sentence)
         tree_writer.writerows(lines)
-    except IOError:
-        print("IO error opening %s" % filename)
+    except Exception:
+        if tree_file:
+            tree_file.close()
+            os.remove(filename)
+        raise
     finally:
         if tree_file:
             tree_file.close()
 
 # get dir path and name of v, calculates truth value in main csv (calls Node methode evaluate_in_v)
-def add_v_to_main_csv(dir_path, sentence, v, verb_dict_v):
+# on failure or cancel the partial v lines are cut off so the file stays as it was
+# progress (optional) is called with status text while lines are written
+def add_v_to_main_csv(dir_path, sentence, v, verb_dict_v, progress=None):
+    global line_count
     file = None
+    start_pos = 0
+    start_line = line_count
     try:
         file = open(r"%s\F1_temp.csv" % dir_path, "ab")
+        start_pos = file.tell()
         v_writer = csv.writer(file, encoding='utf-8')
+        if progress:
+            v_writer = ProgressWriter(v_writer, progress)
         sentence.evaluate_in_v(v, v_writer, verb_dict_v=verb_dict_v, v={})
-    except IOError:
-        print("IO error in appending v")
+    except Exception:
+        line_count = start_line
+        if file:
+            file.truncate(start_pos)
+        raise
     finally:
         if file:
             file.close()
 
-# get csv path and new filename, creates xlsx and deletes original csv
-def save_xlsx_delete(filepath, newname):
-    read_file = pd.read_csv(filepath)
-    read_file.to_excel((r"%s" % (filepath.replace("F1_temp", newname).replace(".csv", ".xlsx"))),
-                       index=None, header=True)
+# get csv path and new filename, creates xlsx in chunks and deletes original csv
+# the xlsx is written to a temp file in the same folder and only replaces xlsx_path on success,
+# on failure or cancel just that temp file is removed and the csv is kept
+# progress (optional) is called with status text before each chunk
+def save_xlsx_delete(filepath, newname, progress=None):
+    xlsx_path = filepath.replace("F1_temp", newname).replace(".csv", ".xlsx")
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(xlsx_path))
+    os.close(fd)
+    try:
+        with pd.ExcelWriter(tmp_path) as excel_writer:
+            next_row = 0
+            for chunk in pd.read_csv(filepath, chunksize=export_chunk_size):
+                if progress:
+                    progress("Exported %d lines" % max(next_row - 1, 0))
+                chunk.to_excel(excel_writer, index=None, header=(next_row == 0), startrow=next_row)
+                next_row += len(chunk) + (1 if next_row == 0 else 0)
+            # last chance to cancel, the workbook save on leaving the with block can't be stopped
+            if progress:
+                progress("Writing workbook", cancellable=False)
+        os.replace(tmp_path, xlsx_path)
+    except Exception:
+        # a failed remove must not hide the original error
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
     os.remove(filepath)
     # except FileCreateError:
     #    global sen_obj
@@ -410,6 +485,90 @@ def convert_str_to_group_list(string, f1_type):
             out_list = string.lower().split(",")
     return out_list
 
+# progress callback given to worker tasks: stops the task if the user cancelled, otherwise posts text to the Tk thread
+# cancellable=False marks the start of a step that can't be stopped, the cancel button is then disabled
+def report_progress(text, cancellable=True):
+    if cancel_event.is_set():
+        raise Cancelled()
+    task_queue.put(("progress", (text, cancellable)))
+
+# runs task(progress) in a worker thread while showing a progress window with a cancel button,
+# the result (or raised exception) is handed back through task_queue to on_done (or on_error) on the Tk thread
+def run_in_worker(title, task, on_done, on_error):
+    global task_win
+    cancel_event.clear()
+    task_win = tk.Toplevel(win)
+    task_win.configure(bg="#2b2b2b")
+    task_win.title(title)
+    task_win.resizable(0, 0)
+    task_win.transient(win)
+    lbl_task = tk.Label(task_win, text=title, **label_style)
+    lbl_status = tk.Label(task_win, text="Starting...", **label_style)
+    bar = ttk.Progressbar(task_win, mode="indeterminate", length=300)
+
+    def cancel_btn():
+        if btn_cancel["state"] != tk.DISABLED:
+            cancel_event.set()
+            lbl_status["text"] = "Cancelling..."
+
+    btn_cancel = tk.Button(task_win, text="Cancel", **button_style, command=cancel_btn)
+    lbl_task.grid(column=0, row=0, padx=15)
+    lbl_status.grid(column=0, row=1, padx=15)
+    bar.grid(column=0, row=2, padx=15, pady=5)
+    btn_cancel.grid(column=0, row=3, pady=15)
+    task_win.protocol("WM_DELETE_WINDOW", cancel_btn)
+    task_win.grab_set()
+    bar.start(10)
+
+    def work():
+        try:
+            task_queue.put(("done", task(report_progress)))
+        except Exception as e:
+            task_queue.put(("error", e))
+
+    # reads all waiting messages from the worker, reschedules itself until the task is over
+    def poll():
+        global task_win
+        try:
+            while True:
+                kind, value = task_queue.get_nowait()
+                if kind == "progress":
+                    text, cancellable = value
+                    if not cancel_event.is_set():
+                        lbl_status["text"] = text
+                    if not cancellable:
+                        btn_cancel["state"] = tk.DISABLED
+                else:
+                    task_win.grab_release()
+                    task_win.destroy()
+                    task_win = None
+                    if kind == "done":
+                        # cancel was pressed after the last check, the task still finished
+                        if cancel_event.is_set():
+                            messagebox.showinfo("Too late to cancel", "The task had already finished")
+                        on_done(value)
+                    else:
+                        on_error(value)
+                    return
+        except queue.Empty:
+            pass
+        win.after(poll_interval_ms, poll)
+
+    threading.Thread(target=work, daemon=True).start()
+    win.after(poll_interval_ms, poll)
+
+# shows the error for a failed save to exel
+def show_save_error(e, name):
+    if isinstance(e, Cancelled):
+        messagebox.showinfo("Save cancelled", "The file was not saved.\nYour temp file was kept.")
+    else:
+        messagebox.showerror("Failed save", "Error: could not save.\n"
+                                            "make sure no file with name:\n"
+                                            "%s.xlsx\n"
+                                            "is open, and that you can\n"
+                                            "save files to your selected\n"
+                                            "output folder.\n\n%s" % (name, e))
+
 # function for main frame evaluation button, create second page for inputing group members in v
 def get_group_members_btn():
     global sen_obj
@@ -435,25 +594,37 @@ def get_group_members_btn():
             i += 1
 
         # creting the button that will be in the second frame
-        # reading fron all entrys for verbs group members, evaluate v in file (calls add_v_to_main_csv)
+        # reading fron all entrys for verbs group members, evaluate v in file in a worker (calls add_v_to_main_csv)
         def eval_btn():
-            global verb_dict
-            global vs_list
-            if v_entry.get() in vs_list:
-                messagebox.showwarning("V name", "State of reality:\nv%s\n already exists in your file" % v_entry.get())
+            v_name = v_entry.get()
+            if v_name in vs_list:
+                messagebox.showwarning("V name", "State of reality:\nv%s\n already exists in your file" % v_name)
             else:
-                try:
-                    verb_dict = dict([(v[0],
-                                       convert_str_to_group_list(verb_dict[v].get(),
-                                                                 v[1])) for v in verb_dict.keys()])
-                    global sen_obj
-                    add_v_to_main_csv(entry_path.get(), sen_obj, "v" + v_entry.get(), verb_dict)
+                # widgets are only read here on the Tk thread, the worker gets plain strings
+                dir_path = entry_path.get()
+                sentence = sen_obj
+                groups = [(v, verb_dict[v].get()) for v in verb_dict.keys()]
+
+                def eval_task(progress):
+                    verb_dict_v = dict([(v[0], convert_str_to_group_list(text, v[1])) for v, text in groups])
+                    add_v_to_main_csv(dir_path, sentence, "v" + v_name, verb_dict_v, progress)
+
+                def eval_done(result):
+                    global vs_list
                     frame_v.pack_forget()
                     frame_main.pack()
-                    vs_list += v_entry.get()
-                except pp.ParseException:
-                    simpledialog.messagebox.showwarning("bad input", "The group does not match format\n"
-                                                                     "<x,y>,<z,w>....\nTry again")
+                    vs_list += v_name
+
+                def eval_error(e):
+                    if isinstance(e, Cancelled):
+                        messagebox.showinfo("Evaluation cancelled", "v%s was not added to your file" % v_name)
+                    elif isinstance(e, pp.ParseException):
+                        simpledialog.messagebox.showwarning("bad input", "The group does not match format\n"
+                                                                         "<x,y>,<z,w>....\nTry again")
+                    else:
+                        messagebox.showerror("Failed evaluation", "Error: could not evaluate v%s\n\n%s" % (v_name, e))
+
+                run_in_worker("Evaluating in v%s" % v_name, eval_task, eval_done, eval_error)
 
         btn_eval = tk.Button(frame_v, text="Evaluate", **button_style, command=eval_btn)
         btn_eval.grid(column=1, row=i)
@@ -469,21 +640,16 @@ def browse_btn():
 def close_btn():
     global sen_obj
 
-    if sen_obj:
+    if task_win:
+        messagebox.showwarning("Busy", "Please wait for the running task to finish or cancel it before exiting")
+    elif sen_obj:
         opt = messagebox.askyesnocancel("Unsaved",
                                         "You have not saved your file.\nDo you wish to save as exel before exiting?")
         filepath = entry_path.get() + "/F1_temp.csv"
         if opt:
-            try:
-                save_xlsx_delete(filepath, sen_obj.text)
-                win.destroy()
-            except:
-                messagebox.showerror("Failed save", "Error: could not save.\n"
-                                                    "make sure no file with name:\n"
-                                                    "%s.xlsx\n"
-                                                    "is open, and that you can\n"
-                                                    "save files to your selected\n"
-                                                    "output folder." % sen_obj.text)
+            name = sen_obj.text
+            run_in_worker("Saving to exel", lambda progress: save_xlsx_delete(filepath, name, progress),
+                          lambda result: win.destroy(), lambda e: show_save_error(e, name))
         elif str(opt) == "False":
             os.remove(filepath)
             os.remove(filepath.replace("/F1_temp", "/%s (tree)" % sen_obj.text))
@@ -491,38 +657,57 @@ def close_btn():
     else:
         win.destroy()
 
-# function for create button, makes the temp csv and creates sentence object
+# function for create button, makes the temp csv and creates sentence object in a worker
 def create_btn():
     if not entry_path.get():
         messagebox.showwarning("no folder path", "The output folder path is empty")
     else:
-        try:
-            s.parseString(entry_sen.get())
+        dir_path = entry_path.get()
+        sentence = entry_sen.get()
+
+        # on failure or cancel only the files created by this task are removed
+        def create_task(progress):
+            global line_count
+            global node_count
+            line_count = 0
+            node_count = 0
+            sen = make_main_csv(dir_path, sentence, progress)
             try:
-                global sen_obj
-                global line_count
-                global node_count
-                line_count = 0
-                node_count = 0
-                sen_obj = make_main_csv(entry_path.get(), entry_sen.get())
-                make_hirarchy_csv(entry_path.get(), sen_obj)
-                btn_create["state"] = tk.DISABLED
-                btn_browse["state"] = tk.DISABLED
-                btn_save["state"] = tk.NORMAL
-                btn_getgroups["state"] = tk.NORMAL
-                entry_path["state"] = tk.DISABLED
-                entry_sen["state"] = tk.DISABLED
-                tk.messagebox.showinfo("sucess", "temp file created sucessfully")
-            except:
+                make_hirarchy_csv(dir_path, sen)
+            except Exception:
+                os.remove(r"%s\F1_temp.csv" % dir_path)
+                raise
+            return sen
+
+        def create_done(sen):
+            global sen_obj
+            sen_obj = sen
+            btn_create["state"] = tk.DISABLED
+            btn_browse["state"] = tk.DISABLED
+            btn_save["state"] = tk.NORMAL
+            btn_getgroups["state"] = tk.NORMAL
+            entry_path["state"] = tk.DISABLED
+            entry_sen["state"] = tk.DISABLED
+            tk.messagebox.showinfo("sucess", "temp file created sucessfully")
+
+        def create_error(e):
+            if isinstance(e, Cancelled):
+                messagebox.showinfo("Creation cancelled", "No temp file was created")
+            elif isinstance(e, (pp.ParseException, ValueError)):
                 messagebox.showwarning("bad sentence", "The sentece does not follow F1 rules")
-        except pp.ParseException:
-            messagebox.showwarning("bad sentence", "The sentece does not follow F1 rules")
+            else:
+                messagebox.showerror("Failed creation", "Error: could not create files in your\n"
+                                                        "selected output folder.\n\n%s" % e)
+
+        run_in_worker("Creating temp file", create_task, create_done, create_error)
 
-# saves temp csv as exel, enable creation of new sentence+file
+# saves temp csv as exel in a worker, enable creation of new sentence+file
 def save_btn():
-    global sen_obj
-    try:
-        save_xlsx_delete(entry_path.get() + "/F1_temp.csv", sen_obj.text)
+    filepath = entry_path.get() + "/F1_temp.csv"
+    name = sen_obj.text
+
+    def save_done(result):
+        global sen_obj
         global verb_dict
         global vs_list
         verb_dict = {}
@@ -536,13 +721,9 @@ def save_btn():
         entry_path["state"] = tk.NORMAL
         entry_sen["state"] = tk.NORMAL
         entry_sen.delete(0, "end")
-    except:
-        messagebox.showerror("Failed save", "Error: could not save.\n"
-                                            "make sure no file with name:\n"
-                                            "%s.xlsx\n"
-                                            "is open, and that you can\n"
-                                            "save files to your selected\n"
-                                            "output folder." % sen_obj.text)
+
+    run_in_worker("Saving to exel", lambda progress: save_xlsx_delete(filepath, name, progress),
+                  save_done, lambda e: show_save_error(e, name))
 
 
 # shows messegbox with usage info
@@ -589,6 +770,13 @@ sen_obj = None
 verb_dict = {}
 vs_list = [""]
 
+# background work: messages from the worker thread to the Tk thread, and the cancel flag
+task_queue = queue.Queue()
+cancel_event = threading.Event()
+task_win = None
+poll_interval_ms = 100
+export_chunk_size = 1000
+
 # Literals to ingnore in parsing
 lpar = pp.Literal("[").suppress()
 rpar = pp.Literal("]").suppress()